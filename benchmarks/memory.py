@@ -0,0 +1,52 @@
+"""Report peak RSS and per-phase memory for rendering a large document.
+
+Run from any directory:
+
+    python3 benchmarks/memory.py --size 4
+
+Each run renders one document in this process, so run it once per
+configuration when comparing peak RSS.
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+from parse_html import make_document
+
+def peak_rss():
+    # Linux reports ru_maxrss in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=4,
+                        help="document size in MB")
+    args = parser.parse_args()
+
+    browser.set_font_backend(browser.HeadlessFontBackend())
+    body = make_document(args.size)
+    start_rss = peak_rss()
+    start = time.perf_counter()
+    nodes = browser.HTMLParser(body).parse()
+    parsed_rss = peak_rss()
+    tab = browser.Tab(browser.HEIGHT)
+    tab.url = browser.URL("http://example.org/")
+    tab.render(nodes, {})
+    elapsed = time.perf_counter() - start
+    rendered_rss = peak_rss()
+
+    mb = 1024 * 1024
+    print("document     {:6.1f} MB".format(len(body.encode("utf8")) / mb))
+    for phase, size in browser.memory_report(tab).items():
+        print("{:<12} {:6.1f} MB".format(phase, size / mb))
+    print("peak RSS     {:6.1f} MB (+{:.1f} MB for the DOM)".format(
+        rendered_rss / mb, (parsed_rss - start_rss) / mb))
+    print("time         {:6.1f} s".format(elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Measure HTMLParser throughput on a synthetic document.
+
+Run from the repository root:
+
+    python3 benchmarks/parse_html.py --size 4 --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+
+PARAGRAPH = (
+    '<div class="section" id="s{0}">\n'
+    '  <h2>Section {0}</h2>\n'
+    '  <!-- section {0} starts here -->\n'
+    '  <p style="color: blue">Lorem ipsum dolor sit amet, <b>consectetur</b>\n'
+    '  adipiscing elit, sed do <i>eiusmod</i> tempor incididunt ut labore\n'
+    '  et dolore magna aliqua. <a href="/page/{0}">Read more</a></p>\n'
+    '  <ul><li>one</li><li>two</li><li>three</li></ul>\n'
+    '</div>\n'
+)
+
+def make_document(megabytes):
+    target = int(megabytes * 1024 * 1024)
+    parts = ["<html><head><title>Benchmark</title></head><body>\n"]
+    size = len(parts[0])
+    i = 0
+    while size < target:
+        part = PARAGRAPH.format(i)
+        parts.append(part)
+        size += len(part)
+        i += 1
+    parts.append("</body></html>\n")
+    return "".join(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=2,
+                        help="document size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk", type=int, default=0,
+                        help="feed the document in chunks of this many bytes")
+    args = parser.parse_args()
+
+    body = make_document(args.size)
+    megabytes = len(body.encode("utf8")) / (1024 * 1024)
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        if args.chunk:
+            html = browser.HTMLParser()
+            for i in range(0, len(body), args.chunk):
+                html.feed(body[i:i + args.chunk])
+            html.close()
+        else:
+            browser.HTMLParser(body).parse()
+        best = min(best, time.perf_counter() - start)
+    print("parsed {:.2f} MB in {:.3f}s: {:.2f} MB/s".format(
+        megabytes, best, megabytes / best))
+
+if __name__ == "__main__":
+    main()
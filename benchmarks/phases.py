@@ -0,0 +1,214 @@
+"""Time each phase of Tab.load on synthetic documents of growing size.
+
+Run from any directory:
+
+    python3 benchmarks/phases.py --sizes 50,100,200,400 --output after.json
+    python3 benchmarks/phases.py --compare before.json
+
+Documents are served from a local HTTP server and rendered with the
+headless font backend, so no display is needed.
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import browser
+
+PHASES = ["fetch", "html", "css", "style", "layout", "paint"]
+
+TAGS = ["div", "p", "span", "b", "i", "a", "em", "strong", "section",
+        "article", "ul", "li", "h2", "small", "code"]
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+         "adipiscing", "elit", "sed", "do", "eiusmod", "tempor"]
+
+def make_document(sections, depth, fanout, text_length, seed=0):
+    r = random.Random(seed)
+    parts = ['<html><head><link rel="stylesheet" href="/style.css">'
+             '<title>Benchmark</title></head><body>']
+    for i in range(sections):
+        parts.append('<div class="section">' * depth)
+        for _ in range(fanout):
+            words = [r.choice(WORDS) for _ in range(text_length)]
+            for j in range(0, len(words), 7):
+                tag = r.choice(["b", "i", "a", "span"])
+                words[j] = "<{0}>{1}</{0}>".format(tag, words[j])
+            parts.append("<p>" + " ".join(words) + "</p>")
+        parts.append("</div>" * depth)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+def make_style_sheet(rules, selector_depth, seed=0):
+    r = random.Random(seed)
+    lines = []
+    for i in range(rules):
+        depth = r.randint(1, selector_depth)
+        selector = " ".join(r.choice(TAGS) for _ in range(depth))
+        lines.append("{} {{ color: c{}; background-color: transparent; }}"
+                     .format(selector, i))
+    return "\n".join(lines)
+
+class Server:
+    def __init__(self):
+        self.files = {}
+        files = self.files
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = files.get(self.path, "").encode("utf8")
+                self.send_response(200 if self.path in files else 404)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.port = self.httpd.server_address[1]
+
+    def url(self, path):
+        return browser.URL("http://127.0.0.1:{}{}".format(self.port, path))
+
+def run_once(server):
+    browser.set_font_backend(browser.HeadlessFontBackend())
+    times = {}
+    def phase(name, f, *args):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = f(*args)
+        times[name] = times.get(name, 0) + time.perf_counter() - start
+        return result
+
+    url = server.url("/index.html")
+    body = phase("fetch", url.request)
+    css_body = phase("fetch", server.url("/style.css").request)
+    nodes = phase("html", lambda: browser.HTMLParser(body).parse())
+    rules = browser.default_style_sheet().copy()
+    rules.extend(phase("css", lambda: browser.CSSParser(css_body).parse()))
+    index = browser.RuleIndex(sorted(rules, key=browser.cascade_priority))
+    phase("style", browser.style, nodes, index)
+    document = browser.DocumentLayout(nodes)
+    phase("layout", document.layout)
+    display_list = []
+    phase("paint", browser.paint_tree, document, display_list)
+    counts = {
+        "nodes": len(browser.tree_to_list(nodes, [])),
+        "rules": len(rules),
+        "display_list": len(display_list),
+    }
+    return times, counts
+
+def run(args, sections, server):
+    body = make_document(sections, args.depth, args.fanout, args.text_length)
+    css = make_style_sheet(args.rules, args.selector_depth)
+    server.files["/index.html"] = body
+    server.files["/style.css"] = css
+    best = None
+    for _ in range(args.repeat):
+        times, counts = run_once(server)
+        if best is None:
+            best = times
+        else:
+            best = {k: min(best[k], times[k]) for k in best}
+    megabytes = len(body.encode("utf8")) / (1024 * 1024)
+    return {
+        "sections": sections,
+        "megabytes": megabytes,
+        "counts": counts,
+        "seconds": best,
+        "throughput": {
+            "fetch_mb_per_s": megabytes / best["fetch"],
+            "html_mb_per_s": megabytes / best["html"],
+            "style_nodes_per_s": counts["nodes"] / best["style"],
+            "layout_nodes_per_s": counts["nodes"] / best["layout"],
+            "paint_commands_per_s": counts["display_list"] / best["paint"],
+        },
+    }
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def print_table(results, baseline=None):
+    header = "{:>8} {:>8} {:>7}".format("sections", "MB", "nodes")
+    for name in PHASES:
+        header += " {:>9}".format(name + " ms")
+    print(header)
+    for i, result in enumerate(results):
+        line = "{:>8} {:>8.2f} {:>7}".format(
+            result["sections"], result["megabytes"],
+            result["counts"]["nodes"])
+        for name in PHASES:
+            line += " {:>9.1f}".format(result["seconds"][name] * 1000)
+        print(line)
+        if baseline and i < len(baseline):
+            line = "{:>8} {:>8} {:>7}".format("", "", "speedup")
+            for name in PHASES:
+                line += " {:>8.2f}x".format(
+                    baseline[i]["seconds"][name] / result["seconds"][name])
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="25,50,100,200",
+                        help="comma-separated numbers of sections")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="nesting depth of each section")
+    parser.add_argument("--fanout", type=int, default=5,
+                        help="paragraphs per section")
+    parser.add_argument("--text-length", type=int, default=40,
+                        help="words per paragraph")
+    parser.add_argument("--rules", type=int, default=200,
+                        help="number of CSS rules")
+    parser.add_argument("--selector-depth", type=int, default=3,
+                        help="maximum number of tags per selector")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    server = Server()
+    results = [run(args, int(size), server)
+               for size in args.sizes.split(",")]
+    print_table(results, baseline)
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "parameters": {k: v for k, v in vars(args).items()
+                           if k not in ["output", "compare"]},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Measure how long it takes to import browser and load the default style sheet.
+
+Run from any directory:
+
+    python3 benchmarks/startup.py --repeat 20
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import browser
+print(time.perf_counter() - start)
+"""
+
+STYLE_SHEET = """
+import sys, time
+sys.path.insert(0, {root!r})
+import browser
+browser.COMPILED_STYLE_SHEET_PATH = {compiled!r}
+start = time.perf_counter()
+browser.default_style_sheet()
+print(time.perf_counter() - start)
+"""
+
+def run(code, repeat, before=None):
+    times = []
+    for _ in range(repeat):
+        if before: before()
+        out = subprocess.run([sys.executable, "-c", code], cwd="/",
+                             check=True, capture_output=True, text=True)
+        times.append(float(out.stdout.split()[-1]))
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    compiled = os.path.join(scratch, "browser.css.json")
+    def clear():
+        if os.path.exists(compiled): os.remove(compiled)
+    try:
+        results = [
+            ("import browser", IMPORT.format(root=ROOT), None),
+            ("default style sheet, parsed", STYLE_SHEET.format(
+                root=ROOT, compiled=compiled), clear),
+            ("default style sheet, precompiled", STYLE_SHEET.format(
+                root=ROOT, compiled=compiled), None),
+        ]
+        for name, code, before in results:
+            elapsed = run(code, args.repeat, before)
+            print("{:<34} {:8.2f} ms".format(name, elapsed * 1000))
+    finally:
+        shutil.rmtree(scratch)
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,473 @@
+import atexit
+import bisect
+import codecs
+import collections
+import contextlib
+import copy
+import gc
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
 import socket
-import ssl
+import sys
+import threading
 import time
-import tkinter
-import tkinter.font
+import traceback
+import types
+import unicodedata
+import zlib
 
 class RedirectLoopError(Exception): pass
 
+class LoadCancelled(Exception): pass
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, category=self.category,
+                             args=self.args)
+        return False
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = {}
+        self.last = {}
+        self.origin = time.perf_counter()
+        self.null_span = contextlib.nullcontext()
+
+    def span(self, name, category="browser", args=None):
+        if not self.enabled: return self.null_span
+        return Span(self, name, category, args)
+
+    def complete(self, name, start, end=None, category="browser", args=None):
+        if not self.enabled: return
+        if end is None: end = time.perf_counter()
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+        }
+        if args: event["args"] = args
+        self.events.append(event)
+        self.last[name] = end - start
+
+    def count(self, name, value=1):
+        if not self.enabled: return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_counter(self, name, value):
+        if not self.enabled: return
+        self.counters[name] = value
+
+    def emit_counters(self):
+        if not self.enabled: return
+        self.events.append({
+            "name": "counters", "ph": "C",
+            "ts": (time.perf_counter() - self.origin) * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "args": dict(self.counters),
+        })
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, f)
+
+tracer = Tracer()
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip()
+        if not directive: continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip().casefold()] = arg.strip().strip('"')
+        else:
+            directives[directive.casefold()] = None
+    return directives
+
 class CacheItem:
-    def __init__(self, content, max_age):
-        self.content = content
+    def __init__(self, digest, size, max_age, no_cache,
+                 etag=None, last_modified=None, add_time=None):
+        self.digest = digest
+        self.size = size
         self.max_age = max_age
-        self.add_time = time.time()
+        self.no_cache = no_cache
+        self.etag = etag
+        self.last_modified = last_modified
+        self.add_time = time.time() if add_time is None else add_time
+        self.content = None
+
+    def fresh(self):
+        if self.no_cache or self.max_age is None: return False
+        return time.time() - self.add_time < self.max_age
+
+    def revalidatable(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def validators(self):
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_json(self):
+        return {
+            "digest": self.digest, "size": self.size,
+            "max_age": self.max_age, "no_cache": self.no_cache,
+            "etag": self.etag, "last_modified": self.last_modified,
+            "add_time": self.add_time,
+        }
 
-class Cache:
-    def __init__(self):
-        self.cache = {}
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["digest"], data["size"], data["max_age"],
+                   data["no_cache"], data["etag"], data["last_modified"],
+                   data["add_time"])
 
-    def add(self, key, content, max_age):
-        self.cache[key] = CacheItem(content, max_age)
+class Cache:
+    INDEX_FILE = "index.json"
+    # Changes to the index are written out at most this often, and at exit.
+    SAVE_DELAY = 1
+
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.dirty = False
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+            atexit.register(self.save)
+
+    def body_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def load(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, data in entries:
+            item = CacheItem.from_json(data)
+            if not os.path.exists(self.body_path(item.digest)): continue
+            self.cache[key] = item
+            self.size += item.size
+
+    def changed(self):
+        if self.directory is None or self.dirty: return
+        self.dirty = True
+        timer = threading.Timer(self.SAVE_DELAY, self.save)
+        timer.daemon = True
+        timer.start()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty: return
+            self.dirty = False
+            entries = [[key, item.to_json()]
+                       for key, item in self.cache.items()]
+            index = os.path.join(self.directory, self.INDEX_FILE)
+            with open(index + ".tmp", "w") as f:
+                json.dump(entries, f)
+            os.replace(index + ".tmp", index)
+
+    def add(self, key, content, response_headers):
+        directives = parse_cache_control(
+            response_headers.get("cache-control", ""))
+        with self.lock:
+            if "no-store" in directives:
+                self.remove(key)
+                return
+            max_age = None
+            if directives.get("max-age"):
+                try:
+                    max_age = int(directives["max-age"])
+                except ValueError:
+                    pass
+            item = CacheItem(
+                None, 0, max_age, "no-cache" in directives,
+                response_headers.get("etag"),
+                response_headers.get("last-modified"))
+            if not item.fresh() and not item.revalidatable(): return
+            data = content.encode("utf8")
+            item.size = len(data)
+            if item.size > self.max_bytes: return
+            self.remove(key)
+            item.digest = hashlib.sha256(data).hexdigest()
+            if self.directory is None:
+                item.content = content
+            elif not os.path.exists(self.body_path(item.digest)):
+                with open(self.body_path(item.digest), "wb") as f:
+                    f.write(data)
+            self.cache[key] = item
+            self.size += item.size
+            self.evict()
+            self.changed()
+
+    def refresh(self, key, response_headers):
+        directives = parse_cache_control(
+            response_headers.get("cache-control", ""))
+        with self.lock:
+            item = self.cache.get(key)
+            if item is None: return
+            if "max-age" in directives:
+                try:
+                    item.max_age = int(directives["max-age"])
+                except ValueError:
+                    item.max_age = None
+            if "no-cache" in directives:
+                item.no_cache = True
+            item.etag = response_headers.get("etag", item.etag)
+            item.last_modified = response_headers.get(
+                "last-modified", item.last_modified)
+            item.add_time = time.time()
+            self.changed()
 
     def get(self, key):
-        if key in self.cache:
-            item = self.cache[key]
-            if time.time() - item.add_time < item.max_age:
-                return item.content
-            else:
-                del self.cache[key]
-        return None
+        # The body is read under the lock: once it is released, another
+        # thread's add() may evict the entry and delete its file.
+        with self.lock:
+            item = self.cache.get(key)
+            if item is None: return None, None
+            if not item.fresh() and not item.revalidatable():
+                self.remove(key)
+                return None, None
+            try:
+                content = self.content(item)
+            except (OSError, UnicodeDecodeError):
+                self.remove(key)
+                return None, None
+            self.cache.move_to_end(key)
+            return item, content
+
+    def content(self, item):
+        if item.content is not None:
+            return item.content
+        with open(self.body_path(item.digest), "rb") as f:
+            return f.read().decode("utf8")
+
+    def remove(self, key):
+        item = self.cache.pop(key, None)
+        if item is None: return
+        self.size -= item.size
+        self.changed()
+        if self.directory is None: return
+        if any(other.digest == item.digest for other in self.cache.values()):
+            return
+        try:
+            os.remove(self.body_path(item.digest))
+        except OSError:
+            pass
+
+    def evict(self):
+        for key, item in list(self.cache.items()):
+            if not item.fresh() and not item.revalidatable():
+                self.remove(key)
+        while self.size > self.max_bytes and self.cache:
+            key = next(iter(self.cache))
+            self.remove(key)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "browser")
 
 cache = Cache()
 
+class Connection:
+    def __init__(self, key, socket, response):
+        self.key = key
+        self.socket = socket
+        self.response = response
+        self.reused = False
+        self.idle_since = time.time()
+
+    def close(self):
+        self.response.close()
+        self.socket.close()
+
+class ConnectionPool:
+    def __init__(self, max_per_host=6, idle_timeout=60, acquire_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.idle = {}
+        self.open = {}
+        self.lock = threading.Condition()
+
+    def connect(self, scheme, host, port):
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP
+        )
+        address = (host, port)
+        if tracer.enabled:
+            # Resolve separately so DNS time shows up as its own span.
+            with tracer.span("dns", "network", {"host": host}):
+                address = socket.getaddrinfo(
+                    host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        with tracer.span("connect", "network", {"host": host}):
+            s.connect(address)
+        if scheme == 'https':
+            import ssl
+            with tracer.span("tls", "network", {"host": host}):
+                ctx = ssl.create_default_context()
+                s = ctx.wrap_socket(s, server_hostname=host)
+        return s
+
+    def acquire(self, scheme, host, port, fresh=False):
+        key = (scheme, host, port)
+        deadline = time.time() + self.acquire_timeout
+        with self.lock:
+            while True:
+                idle = self.idle.get(key, [])
+                while idle:
+                    conn = idle.pop()
+                    if fresh or \
+                            time.time() - conn.idle_since >= self.idle_timeout:
+                        conn.close()
+                        self.open[key] -= 1
+                        continue
+                    conn.reused = True
+                    return conn
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        "no free connection to {}:{}".format(host, port))
+                self.lock.wait(remaining)
+        try:
+            s = self.connect(scheme, host, port)
+        except Exception:
+            with self.lock:
+                self.open[key] -= 1
+                self.lock.notify()
+            raise
+        return Connection(key, s, s.makefile('rb'))
+
+    def release(self, conn, reusable=True):
+        with self.lock:
+            if reusable:
+                conn.idle_since = time.time()
+                self.idle.setdefault(conn.key, []).append(conn)
+            else:
+                conn.close()
+                self.open[conn.key] -= 1
+            self.lock.notify()
+
+    def close_all(self):
+        with self.lock:
+            for key, idle in self.idle.items():
+                for conn in idle:
+                    conn.close()
+                    self.open[key] -= 1
+            self.idle.clear()
+            self.lock.notify_all()
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
+
+class BodyReader:
+    BLOCK_SIZE = 16384
+
+    def __init__(self, response, headers, status=200):
+        self.response = response
+        self.chunked = "chunked" in \
+            headers.get("transfer-encoding", "").casefold()
+        self.length = None
+        if status in [204, 304] or 100 <= status < 200:
+            self.chunked = False
+            self.length = 0
+        elif not self.chunked and "content-length" in headers:
+            self.length = int(headers["content-length"])
+        self.complete = False
+
+    def __iter__(self):
+        if self.chunked:
+            yield from self.read_chunked()
+        elif self.length is not None:
+            yield from self.read_length(self.length)
+        else:
+            while True:
+                block = self.response.read1(self.BLOCK_SIZE)
+                if not block: break
+                yield block
+
+    def read_length(self, length):
+        remaining = length
+        while remaining > 0:
+            block = self.response.read1(min(remaining, self.BLOCK_SIZE))
+            if not block: return
+            remaining -= len(block)
+            yield block
+        self.complete = True
+
+    def read_chunked(self):
+        while True:
+            line = self.response.readline()
+            if not line: return
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0: break
+            remaining = size
+            while remaining > 0:
+                block = self.response.read1(min(remaining, self.BLOCK_SIZE))
+                if not block: return
+                remaining -= len(block)
+                yield block
+            self.response.readline()
+        while True:
+            line = self.response.readline()
+            if not line: return
+            if line in [b"\r\n", b"\n"]: break
+        self.complete = True
+
+def decode_content(blocks, content_encoding):
+    encoding = content_encoding.strip().casefold()
+    if encoding in ["", "identity"]:
+        yield from blocks
+        return
+    if encoding in ["gzip", "x-gzip"]:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        # Accept both zlib-wrapped and raw deflate streams.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    else:
+        raise ValueError("Unsupported content-encoding: " + content_encoding)
+    first = True
+    for block in blocks:
+        try:
+            data = decompressor.decompress(block)
+        except zlib.error:
+            if not (first and encoding == "deflate"): raise
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decompressor.decompress(block)
+        first = False
+        if data: yield data
+    data = decompressor.flush()
+    if data: yield data
+
 class URL:
     def __init__(self, url):
         self.scheme, url = url.split("://")
@@ -65,23 +503,32 @@ class URL:
         return self.scheme + "://" + self.host + port_part + self.path
 
     def request(self, headers=None, redirect_count=0):
+        return "".join(self.stream(headers, redirect_count))
+
+    def stream(self, headers=None, redirect_count=0):
         print('Requesting', self)
         global cache
         if redirect_count == 10:
             raise RedirectLoopError()
-        cached = cache.get(repr(self))
-        if cached is not None:
-            return cached
+        cached, cached_content = cache.get(repr(self))
+        if cached is not None and cached.fresh():
+            yield cached_content
+            return
         if self.scheme == 'file':
             with open(self.path, 'r') as f:
-                return f.read()
+                while True:
+                    block = f.read(BodyReader.BLOCK_SIZE)
+                    if not block: break
+                    yield block
+            return
         assert self.host is not None
         assert self.port is not None
         if headers is None:
             headers = {}
         default_headers = {
             "Host": self.host,
-            "Connection": "close",
+            "Connection": "keep-alive",
+            "Accept-Encoding": "gzip, deflate",
             "User-Agent": "browser"
         }
         sending_headers: dict[str, str] = {}
@@ -89,32 +536,74 @@ class URL:
             sending_headers[k.casefold()] = v
         for (k, v) in headers.items():
             sending_headers[k.casefold()] = v
+        if cached is not None:
+            for (k, v) in cached.validators().items():
+                sending_headers.setdefault(k.casefold(), v)
         sending_headers_str = "\r\n".join(map(lambda x: "{}: {}".format(*x), sending_headers.items())) + "\r\n"
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP
-        )
-        s.connect((self.host, self.port))
-        if self.scheme == 'https':
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
         request = "GET {} HTTP/1.1\r\n".format(self.path)
         request += sending_headers_str
         request += "\r\n"
-        s.send(request.encode("utf8"))
-        response = s.makefile('r', encoding='utf8', newline='\r\n')
-        statusline = response.readline()
-        version, status, explanation = statusline.split(' ', 2)
-        response_headers: dict[str, str] = {}
-        while True:
-            line = response.readline()
-            if line == '\r\n': break
-            header, value = line.split(':', 1)
-            response_headers[header.casefold()] = value.strip()
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-        status = int(status)
+        request_start = time.perf_counter()
+        conn = connection_pool.acquire(self.scheme, self.host, self.port)
+        parts = []
+        try:
+            sent = time.perf_counter()
+            try:
+                conn.socket.send(request.encode("utf8"))
+                statusline = conn.response.readline().decode("utf8")
+            except ConnectionError:
+                if not conn.reused: raise
+                statusline = ""
+            if not statusline and conn.reused:
+                # The server closed or reset the idle connection; retry
+                # on a fresh one.
+                connection_pool.release(conn, reusable=False)
+                conn = None
+                conn = connection_pool.acquire(
+                    self.scheme, self.host, self.port, fresh=True)
+                conn.socket.send(request.encode("utf8"))
+                statusline = conn.response.readline().decode("utf8")
+            version, status, explanation = statusline.split(' ', 2)
+            response_headers: dict[str, str] = {}
+            while True:
+                line = conn.response.readline().decode("utf8")
+                if line in ['\r\n', '\n', '']: break
+                header, value = line.split(':', 1)
+                response_headers[header.casefold()] = value.strip()
+            status = int(status)
+            body_start = time.perf_counter()
+            tracer.complete("first byte", sent, body_start, "network",
+                            {"url": repr(self)})
+            reader = BodyReader(conn.response, response_headers, status)
+            if status >= 300 and status < 400:
+                for _ in reader: pass
+            else:
+                decoder = codecs.getincrementaldecoder("utf8")()
+                for block in decode_content(
+                        reader, response_headers.get("content-encoding", "")):
+                    text = decoder.decode(block)
+                    if not text: continue
+                    parts.append(text)
+                    yield text
+                text = decoder.decode(b"", final=True)
+                if text:
+                    parts.append(text)
+                    yield text
+            reusable = reader.complete and \
+                response_headers.get("connection", "").casefold() != "close"
+        except BaseException:
+            if conn is not None:
+                connection_pool.release(conn, reusable=False)
+            raise
+        connection_pool.release(conn, reusable)
+        tracer.complete("body", body_start, category="network",
+                        args={"url": repr(self)})
+        tracer.complete("request", request_start, category="network",
+                        args={"url": repr(self), "status": status})
+        if status == 304 and cached is not None:
+            cache.refresh(repr(self), response_headers)
+            yield cached_content
+            return
         if status >= 300 and status < 400:
             assert "location" in response_headers
             location = response_headers["location"]
@@ -122,16 +611,16 @@ class URL:
                 redirect_url = URL(f"{self.scheme}://{self.host}:{self.port}{location}")
             else:
                 redirect_url = URL(location)
-            content = redirect_url.request(headers, redirect_count + 1)
-        else :
-            content = response.read()
-        s.close()
-        if 'cache-control' in response_headers:
-            cache_control = response_headers['cache-control']
-            if cache_control.startswith('max-age='):
-                max_age = int(cache_control.split('=')[1])
-                cache.add(repr(self), content, max_age)
-        return content
+            for text in redirect_url.stream(headers, redirect_count + 1):
+                parts.append(text)
+                yield text
+        content = "".join(parts)
+        if status == 200:
+            cache.add(repr(self), content, response_headers)
+        elif status >= 300 and status < 400 and \
+                'cache-control' in response_headers:
+            cache.add(repr(self), content, {
+                'cache-control': response_headers['cache-control']})
 
     def resolve(self, url):
         if "://" in url: return URL(url)
@@ -148,20 +637,86 @@ class URL:
             return URL(f"{self.scheme}://{self.host}:{str(self.port)}{url}")
 
 
+class SubresourceLoader:
+    STYLESHEET_PRIORITY = 0
+
+    def __init__(self, max_workers=8, max_per_host=6):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.host_limits = {}
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def host_limit(self, url):
+        key = (url.scheme, url.host, url.port)
+        with self.lock:
+            if key not in self.host_limits:
+                self.host_limits[key] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+            return self.host_limits[key]
+
+    def start_workers(self):
+        with self.lock:
+            while len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.run, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def run(self):
+        while True:
+            priority, sequence, url, future = self.queue.get()
+            if not future.set_running_or_notify_cancel(): continue
+            try:
+                with self.host_limit(url):
+                    body = url.request()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(body)
+
+    def submit(self, url, priority=STYLESHEET_PRIORITY):
+        import concurrent.futures
+        self.start_workers()
+        future = concurrent.futures.Future()
+        self.queue.put((priority, next(self.sequence), url, future))
+        return future
+
+subresource_loader = SubresourceLoader()
+
+# Text nodes and words never have children; they all share this tuple
+# instead of carrying an empty list each.
+NO_CHILDREN = ()
+
 class Text:
+    __slots__ = ("text", "children", "parent", "style", "style_dirty",
+                 "children_dirty", "layout_dirty")
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
+        self.style_dirty = True
+        self.children_dirty = False
+        self.layout_dirty = True
     def __repr__(self) :
         return repr(self.text)
 
+    def set_text(self, text):
+        self.text = text
+        mark_layout_dirty(self)
+
 class Element:
+    __slots__ = ("tag", "attributes", "children", "parent", "style",
+                 "style_dirty", "children_dirty", "layout_dirty")
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.children = []
         self.attributes = attributes
         self.parent = parent
+        self.style_dirty = True
+        self.children_dirty = False
+        self.layout_dirty = True
     def __repr__(self):
         attrs = [" " + k + "=\"" + v + "\"" for k, v  in self.attributes.items()]
         attr_str = ""
@@ -169,15 +724,79 @@ class Element:
             attr_str += attr
         return "<" + self.tag + attr_str + ">"
 
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+        # Selectors only look at tags, so only the inline style matters.
+        if name == "style": mark_style_dirty(self)
+
+    def remove_attribute(self, name):
+        if name not in self.attributes: return
+        del self.attributes[name]
+        if name == "style": mark_style_dirty(self)
+
+    def set_inline_style(self, property, value):
+        pairs = CSSParser(self.attributes.get("style", "")).body()
+        if value is None:
+            pairs.pop(property.casefold(), None)
+        else:
+            pairs[property.casefold()] = value
+        self.set_attribute("style", "; ".join(
+            "{}: {}".format(k, v) for k, v in pairs.items()))
+
+    def insert_child(self, index, child):
+        if child.parent: child.parent.remove_child(child)
+        child.parent = self
+        self.children.insert(index, child)
+        for node in tree_to_list(child, []):
+            node.style_dirty = True
+        mark_children_dirty(self)
+        mark_layout_dirty(self)
+
+    def append_child(self, child):
+        self.insert_child(len(self.children), child)
+
+    def remove_child(self, child):
+        self.children.remove(child)
+        child.parent = None
+        mark_layout_dirty(self)
+
+def mark_children_dirty(node):
+    while node and not node.children_dirty:
+        node.children_dirty = True
+        node = node.parent
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    mark_children_dirty(node.parent)
+
+def mark_layout_dirty(node):
+    while node and not node.layout_dirty:
+        node.layout_dirty = True
+        node = node.parent
+
+def walk_tree(tree):
+    # Pre-order, like the recursive walks it replaces, but with an explicit
+    # stack so that nesting depth is not limited by the recursion limit.
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.children:
+            stack.extend(reversed(node.children))
+
 def print_tree(node, indent = 0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print(" " * indent, node)
+        stack.extend((child, indent + 2) for child in reversed(node.children))
 
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.tags = [tag]
+        self.ancestor_tags = []
 
     def __repr__(self):
         return "TagSelector(tag={}, priority={})".format(
@@ -191,6 +810,9 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = self.ancestor.priority + self.descendant.priority
+        self.tags = self.ancestor.tags + self.descendant.tags
+        # Tags that must all appear among a matching node's ancestors.
+        self.ancestor_tags = self.ancestor.tags
 
     def __repr__(self):
         return ("DescendantSelector(ancestor={}, descendant={}, priority={})") \
@@ -303,33 +925,169 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
-def style(node, rules):
-    node.style = {}
+class RuleIndex:
+    def __init__(self, rules):
+        self.rules = rules
+        self.buckets = {}
+        for rule in rules:
+            selector, body = rule
+            self.buckets.setdefault(self.key(selector), []).append(rule)
+
+    def key(self, selector):
+        while isinstance(selector, DescendantSelector):
+            selector = selector.descendant
+        return selector.tag
+
+    def candidates(self, node):
+        if not isinstance(node, Element): return []
+        return self.buckets.get(node.tag, [])
+
+class AncestorFilter:
+    SIZE = 1024
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+
+    def slots(self, tag):
+        h = hash(tag)
+        return h % self.SIZE, (h >> 10) % self.SIZE
+
+    def push(self, tag):
+        a, b = self.slots(tag)
+        self.counts[a] += 1
+        self.counts[b] += 1
+
+    def pop(self, tag):
+        a, b = self.slots(tag)
+        self.counts[a] -= 1
+        self.counts[b] -= 1
+
+    def may_contain(self, tag):
+        a, b = self.slots(tag)
+        return self.counts[a] > 0 and self.counts[b] > 0
+
+    def may_contain_all(self, tags):
+        for tag in tags:
+            if not self.may_contain(tag): return False
+        return True
+
+def compute_style(node, rules, ancestors):
+    computed = {}
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
-            node.style[property] = node.parent.style[property]
+            computed[property] = node.parent.style[property]
         else:
-            node.style[property] = default_value
-    for selector, body in rules:
+            computed[property] = default_value
+    matched = 0
+    for selector, body in rules.candidates(node):
+        if not ancestors.may_contain_all(selector.ancestor_tags): continue
         if not selector.matches(node): continue
+        matched += 1
         for property, value in body.items():
-            node.style[property] = value
+            computed[property] = value
+    if tracer.enabled: tracer.count("rules matched", matched)
     if isinstance(node, Element) and "style" in node.attributes:
         pairs = CSSParser(node.attributes["style"]).body()
         for property, value in pairs.items():
-            node.style[property] = value
+            computed[property] = value
 
-    if node.style['font-size'].endswith('%'):
+    if computed['font-size'].endswith('%'):
         if node.parent:
             parent_font_size = node.parent.style["font-size"]
         else:
             parent_font_size = INHERITED_PROPERTIES['font-size']
-        node_pct = float(node.style['font-size'][:-1]) / 100
+        node_pct = float(computed['font-size'][:-1]) / 100
         parent_px = float(parent_font_size[:-2])
-        node.style['font-size'] = f"{node_pct * parent_px}px"
-
-    for child in node.children:
-        style(child, rules)
+        computed['font-size'] = f"{node_pct * parent_px}px"
+    return types.MappingProxyType(computed)
+
+def seed_ancestors(node):
+    ancestors = AncestorFilter()
+    parent = node.parent
+    while parent:
+        ancestors.push(parent.tag)
+        parent = parent.parent
+    return ancestors
+
+def style_node(node, rules, ancestors, shared):
+    # Selectors only look at tags, so nodes with the same tag whose parents
+    # share one style object (and hence the same chain of ancestor tags)
+    # match the same rules and can share the resulting style too.
+    parent_style = node.parent.style if node.parent else None
+    if isinstance(node, Element):
+        shareable = "style" not in node.attributes
+        key = (node.tag, id(parent_style))
+    else:
+        shareable = True
+        key = (None, id(parent_style))
+    entry = shared.get(key) if shareable else None
+    if entry is not None and entry[0] is parent_style:
+        node.style = entry[1]
+    else:
+        node.style = compute_style(node, rules, ancestors)
+        if shareable:
+            shared[key] = (parent_style, node.style)
+    node.style_dirty = False
+
+def style(node, rules, ancestors=None, shared=None):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if ancestors is None:
+        ancestors = seed_ancestors(node)
+    if shared is None:
+        shared = {}
+    # Each element is pushed twice: once to style it and put its tag in
+    # the ancestor filter, and once more, below its children, to take the
+    # tag back out when they are done.
+    stack = [(node, True)]
+    while stack:
+        node, entering = stack.pop()
+        if not entering:
+            ancestors.pop(node.tag)
+            continue
+        style_node(node, rules, ancestors, shared)
+        node.children_dirty = False
+        if not node.children: continue
+        ancestors.push(node.tag)
+        stack.append((node, False))
+        stack.extend((child, True) for child in reversed(node.children))
+
+def restyle(node, rules, ancestors=None, shared=None, force=False):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if ancestors is None:
+        ancestors = seed_ancestors(node)
+    if shared is None:
+        shared = {}
+    stack = [(node, force, True)]
+    while stack:
+        node, force, entering = stack.pop()
+        if not entering:
+            ancestors.pop(node.tag)
+            continue
+        if force or node.style_dirty:
+            old_style = getattr(node, "style", None)
+            style_node(node, rules, ancestors, shared)
+            if old_style != node.style: mark_layout_dirty(node)
+            # Children only see their parent's style through inherited
+            # properties, so they are left alone unless one of those changed.
+            force = old_style is None or any(
+                old_style[property] != node.style[property]
+                for property in INHERITED_PROPERTIES)
+        elif not node.children_dirty:
+            continue
+        node.children_dirty = False
+
+        if not node.children: continue
+        ancestors.push(node.tag)
+        stack.append((node, force, False))
+        stack.extend((child, force, True)
+                     for child in reversed(node.children))
+
+def mark_tags_dirty(node, tags):
+    for node in walk_tree(node):
+        if isinstance(node, Element) and node.tag in tags:
+            mark_style_dirty(node)
 
 class HTMLParser:
 
@@ -343,23 +1101,36 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
-    def __init__(self, body):
+    MARKUP = re.compile(r"<!--|[<>]")
+    SCRIPT_END = re.compile(r"<!--|</script>")
+    ATTRIBUTE_RUN = re.compile(r"[^=\"'\s]+")
+    QUOTED_RUNS = {
+        '"': re.compile(r"[^=\"]+"),
+        "'": re.compile(r"[^=']+"),
+    }
+
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.text = ""
+        self.in_tag = False
+        self.in_comment = False
+        self.in_script = False
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(self.unfinished)
+            if depth == 0 and tag != "html":
                 self.add_tag('html')
-            elif open_tags == ["html"] \
+            elif depth == 1 and self.unfinished[0].tag == "html" \
                 and tag not in ["head", "body", "/html"]:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ['html', 'head'] and \
-                    tag not in ['/head'] + self.HEAD_TAGS:
+            elif depth == 2 and self.unfinished[0].tag == "html" \
+                    and self.unfinished[1].tag == "head" \
+                    and tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -373,7 +1144,7 @@ class HTMLParser:
 
     def get_attributes(self, text):
         splited = text.split(" ", 1)
-        tag = splited[0].casefold()
+        tag = sys.intern(splited[0].casefold())
         if len(splited) == 1:
             return tag, {}
         attribute_text = splited[1]
@@ -384,11 +1155,24 @@ class HTMLParser:
         in_quote = ""
         def add_attribute():
             nonlocal key, value, buffer
-            attributes[key] = value
+            attributes[sys.intern(key)] = value
             key = ""
             value = ""
             buffer = ""
-        for c in attribute_text:
+        i = 0
+        while i < len(attribute_text):
+            # Copy runs of ordinary characters in one step; only "=",
+            # quotes and whitespace change the state below.
+            if in_quote:
+                run = self.QUOTED_RUNS[in_quote].match(attribute_text, i)
+            else:
+                run = self.ATTRIBUTE_RUN.match(attribute_text, i)
+            if run:
+                buffer += run.group()
+                i = run.end()
+                continue
+            c = attribute_text[i]
+            i += 1
             if c == "=":
                 if buffer and not key:
                     key = buffer
@@ -431,9 +1215,7 @@ class HTMLParser:
         self.implicit_tags(tag)
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
@@ -441,83 +1223,341 @@ class HTMLParser:
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            # Attach open elements right away so the partial tree returned
+            # by root() can be rendered while the document is still loading.
+            if parent: parent.children.append(node)
             self.unfinished.append(node)
 
+    def root(self):
+        return self.unfinished[0] if self.unfinished else None
+
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+        del self.unfinished[1:]
         return self.unfinished.pop()
 
+    def feed(self, data):
+        self.body += data
+        self.tokenize(final=False)
+
+    def close(self):
+        self.tokenize(final=True)
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
+        return self.finish()
+
     def parse(self):
-        text = ""
-        in_tag = False
-        in_comment = False
-        in_script = False
+        return self.close()
+
+    def tokenize(self, final):
+        body = self.body
+        text = self.text
         i = 0
-        while i < len(self.body):
-            c = self.body[i]
+        while i < len(body):
+            if self.in_comment:
+                end = body.find("-->", i)
+                if end == -1:
+                    # Keep a possibly split "-->" for the next chunk.
+                    i = len(body) if final else max(i, len(body) - 2)
+                    break
+                self.in_comment = False
+                i = end + 3
+                continue
 
-            if in_comment:
-                if self.body.startswith("-->", i):
-                    in_comment = False
-                    i += 3
+            if self.in_script:
+                m = self.SCRIPT_END.search(body, i)
+                if m is None:
+                    # Keep a possibly split "</script>" for the next chunk.
+                    end = len(body) if final else max(i, len(body) - 8)
+                    text += body[i:end]
+                    i = end
+                    break
+                text += body[i:m.start()]
+                i = m.end()
+                if m.group() == "<!--":
+                    self.in_comment = True
+                    if text: self.add_text(text)
+                    text = ""
                 else:
-                    i += 1
+                    if text:self.add_text(text[:-len("</script>")])
+                    self.add_tag("/script")
+                    text = ""
+                    self.in_script = False
                 continue
 
-            if self.body.startswith("<!--", i):
-                in_comment = True
+            m = self.MARKUP.search(body, i)
+            if m is None:
+                text += body[i:]
+                i = len(body)
+                break
+            start = m.start()
+            if not final and m.group() == "<" and len(body) - start < 4 \
+                    and "<!--".startswith(body[start:]):
+                # A comment opener may be split across chunks; wait for more.
+                text += body[i:start]
+                i = start
+                break
+            text += body[i:start]
+            i = m.end()
+            if m.group() == "<!--":
+                self.in_comment = True
                 if text: self.add_text(text)
                 text = ''
-                i += 4
-                continue
+            elif m.group() == "<":
+                self.in_tag = True
+                if text: self.add_text(text)
+                text = ""
+            else:
+                self.in_tag = False
+                self.add_tag(text)
+                if text.startswith("script"):
+                    self.in_script = True
+                text = ""
 
-            if c == "<":
-                if in_script:
-                    text += c
-                else:
-                    in_tag = True
-                    if text: self.add_text(text)
-                    text = ""
-            elif c == ">":
-                if in_script:
-                    text += c
-                    if text.endswith("</script>"):
-                        text = text[:-len("</script>")]
-                        if text:self.add_text(text[:-len("</script>")])
-                        self.add_tag("/script")
-                        text = ""
-                        in_script = False
-                else:
-                    in_tag = False
-                    self.add_tag(text)
-                    if text.startswith("script"):
-                        in_script = True
-                    elif text == "/script":
-                        in_script = False
-                    text = ""
+        self.body = body[i:]
+        self.text = text
+
+class TkFontBackend:
+    # Tk may only be called from the thread that owns the window. Loads on
+    # other threads hand their Tk calls to it through a queue, batching
+    # measurements so that a page waits on the Tk thread a few times
+    # rather than once per word.
+    def __init__(self):
+        self.thread = None
+        self.tasks = queue.Queue()
+
+    def attach(self):
+        self.thread = threading.current_thread()
+
+    def run_tasks(self):
+        while True:
+            try:
+                fn, done, result = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                result.append(fn())
+            except Exception as e:
+                result.append(e)
+            done.set()
+
+    def queued(self):
+        return self.thread is not None and \
+            threading.current_thread() is not self.thread
+
+    def on_tk_thread(self, fn):
+        if not self.queued():
+            return fn()
+        done = threading.Event()
+        result = []
+        self.tasks.put((fn, done, result))
+        done.wait()
+        if isinstance(result[0], Exception): raise result[0]
+        return result[0]
+
+    def create_font(self, size, weight, style):
+        def create():
+            import tkinter
+            import tkinter.font
+            font = tkinter.font.Font(size=size, weight=weight, slant=style)
+            label = tkinter.Label(font=font)
+            return font, label
+        return self.on_tk_thread(create)
+
+    def font_metrics(self, font):
+        return self.on_tk_thread(font.metrics)
+
+    def measure_texts(self, pairs):
+        return self.on_tk_thread(
+            lambda: [font.measure(text) for font, text in pairs])
+
+# Advance widths of printable ASCII (32-126) in 1/1000 em, from Helvetica.
+HEADLESS_ADVANCES = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333,
+    278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278,
+    584, 584, 584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278,
+    500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+    667, 667, 611, 278, 278, 278, 469, 556, 333, 556, 556, 500, 556, 556,
+    278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500,
+    278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+
+class HeadlessFont:
+    ASCENT, DESCENT = 0.905, 0.212
+    BOLD_FACTOR = 1.1
+
+    def __init__(self, size, weight, style):
+        self.size = size
+        self.weight = weight
+        self.style = style
+        # Tk sizes are in points; layout works in 96dpi pixels.
+        self.pixels = size * 96 / 72
+
+    def __repr__(self):
+        return "HeadlessFont(size={}, weight={}, style={})".format(
+            self.size, self.weight, self.style)
+
+    def measure(self, text):
+        units = 0
+        for c in text:
+            code = ord(c)
+            if 32 <= code < 127:
+                units += HEADLESS_ADVANCES[code - 32]
+            elif unicodedata.east_asian_width(c) in "WF":
+                units += 1000
             else:
-                text += c
-            i += 1
+                units += 556
+        if self.weight == "bold":
+            units *= self.BOLD_FACTOR
+        return round(units * self.pixels / 1000)
+
+    def metrics(self, *options):
+        ascent = round(self.ASCENT * self.pixels)
+        descent = round(self.DESCENT * self.pixels)
+        all = {
+            "ascent": ascent,
+            "descent": descent,
+            "linespace": ascent + descent,
+            "fixed": 0,
+        }
+        if options: return all[options[0]]
+        return all
 
-        if not in_tag and text:
-            self.add_text(text)
+class HeadlessFontBackend:
+    def attach(self):
+        pass
 
-        return self.finish()
+    def run_tasks(self):
+        pass
 
-FONTS = {}
+    def queued(self):
+        return False
+
+    def create_font(self, size, weight, style):
+        return HeadlessFont(size, weight, style), None
 
-def get_font(size, weight, style) -> tkinter.font.Font:
+    def font_metrics(self, font):
+        return font.metrics()
+
+    def measure_texts(self, pairs):
+        return [font.measure(text) for font, text in pairs]
+
+font_backend = TkFontBackend()
+
+FONTS = {}
+FONT_KEYS = {}
+# Guards FONTS, FONT_KEYS and the measure cache, which loads on worker
+# threads share with the Tk thread.
+FONT_LOCK = threading.Lock()
+
+def set_font_backend(backend):
+    global font_backend, measure_cache
+    with FONT_LOCK:
+        font_backend = backend
+        FONTS.clear()
+        FONT_KEYS.clear()
+        measure_cache = MeasureCache()
+
+def get_font(size, weight, style):
     key = (size, weight, style)
-    if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=style)
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+    with FONT_LOCK:
+        if key in FONTS: return FONTS[key][0]
+    # Creating a font may wait for the Tk thread, so it runs unlocked; if
+    # another thread wins the race its font is kept and this one dropped.
+    font, label = font_backend.create_font(size, weight, style)
+    metrics = font_backend.font_metrics(font)
+    with FONT_LOCK:
+        if key not in FONTS:
+            FONTS[key] = (font, label)
+            FONT_KEYS[id(font)] = key
+            measure_cache.font_metrics[key] = metrics
+        return FONTS[key][0]
+
+def node_font(node):
+    weight = node.style["font-weight"]
+    style = node.style["font-style"]
+    if style == "normal": style = "roman"
+    size = int(float(node.style["font-size"][:-2]) * .75)
+    return get_font(size, weight, style)
+
+class MeasureCache:
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.widths = collections.OrderedDict()
+        self.font_metrics = {}
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font, text):
+        with FONT_LOCK:
+            font_key = FONT_KEYS.get(id(font))
+            if font_key is not None:
+                key = (font_key, text)
+                width = self.widths.get(key)
+                if width is not None:
+                    self.hits += 1
+                    self.widths.move_to_end(key)
+                    return width
+                self.misses += 1
+        tracer.count("measure calls")
+        if font_key is None:
+            return font.measure(text)
+        width, = font_backend.measure_texts([(font, text)])
+        self.store([(key, width)])
+        return width
+
+    def measure_all(self, pairs):
+        # Fill the cache for many (font, text) pairs with one call to the
+        # font backend.
+        missing = {}
+        with FONT_LOCK:
+            for font, text in pairs:
+                key = (FONT_KEYS.get(id(font)), text)
+                if key[0] is None or key in self.widths: continue
+                missing[key] = (font, text)
+        if not missing: return
+        with FONT_LOCK:
+            self.misses += len(missing)
+        tracer.count("measure calls", len(missing))
+        widths = font_backend.measure_texts(list(missing.values()))
+        self.store(zip(missing, widths))
+
+    def store(self, entries):
+        with FONT_LOCK:
+            for key, width in entries:
+                self.widths[key] = width
+            while len(self.widths) > self.max_entries:
+                self.widths.popitem(last=False)
+
+    def metrics(self, font, name):
+        # Metrics are stored with the font before get_font returns it and
+        # never change, so reading them needs no lock.
+        font_key = FONT_KEYS.get(id(font))
+        if font_key is None:
+            return font.metrics(name)
+        return self.font_metrics[font_key][name]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.widths),
+        }
+
+measure_cache = MeasureCache()
+
+def prefetch_widths(nodes):
+    # Measure every word layout will ask for in one batch, so a worker
+    # thread waits on the Tk thread once instead of once per new word.
+    pairs = []
+    for node in walk_tree(nodes):
+        if not isinstance(node, Text): continue
+        font = node_font(node)
+        pairs.append((font, " "))
+        pairs.extend((font, word) for word in node.text.split())
+    measure_cache.measure_all(pairs)
 
 WIDTH, HEIGHT = 800, 600
 HSTEP, VSTEP = 13, 18
@@ -531,6 +1571,7 @@ BLOCK_ELEMENTS = [
 ]
 
 class DocumentLayout:
+    __slots__ = ("node", "parent", "children", "x", "y", "width", "height")
 
     def __repr__(self):
         return "DocumentLayout()"
@@ -545,8 +1586,9 @@ class DocumentLayout:
         self.height = None
 
     def layout(self):
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
         self.width = WIDTH - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP
@@ -557,6 +1599,8 @@ class DocumentLayout:
         return []
 
 class BlockLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y",
+                 "width", "height", "cursor_x", "laid_out")
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -566,6 +1610,7 @@ class BlockLayout:
         self.y = None
         self.width = None
         self.height = None
+        self.laid_out = None
 
     def self_rect(self):
         return Rect(
@@ -581,10 +1626,15 @@ class BlockLayout:
             cmds.append(rect)
         return cmds
 
-    def layout_intermediate(self):
+    def layout_intermediate(self, reusable):
         previous = None
         for child in self.node.children:
-            next = BlockLayout(child, self, previous)
+            next = reusable.get(child)
+            if next is None:
+                next = BlockLayout(child, self, previous)
+            else:
+                next.parent = self
+                next.previous = previous
             self.children.append(next)
             previous = next
 
@@ -601,48 +1651,76 @@ class BlockLayout:
             return "block"
 
     def layout(self):
+        # Blocks nest as deeply as the DOM does, so lay them out with an
+        # explicit stack: a block's children are laid out in order between
+        # start_layout and finish_layout, which needs all their heights.
+        stack = [(self, False)]
+        while stack:
+            obj, children_done = stack.pop()
+            if children_done:
+                obj.finish_layout()
+            elif not isinstance(obj, BlockLayout):
+                obj.layout()
+            elif obj.start_layout():
+                stack.append((obj, True))
+                stack.extend((child, False)
+                             for child in reversed(obj.children))
+
+    def start_layout(self):
         self.x = self.parent.x
         self.width = self.parent.width
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+        # Nothing below a clean node changed, so at the same position and
+        # width the previous result only needs moving to the new y.
+        if not self.node.layout_dirty and \
+                self.laid_out == (self.x, self.width):
+            if y != self.y: self.shift(y - self.y)
+            return False
+        self.y = y
         mode = self.layout_mode()
+        reusable = {}
+        if mode == "block":
+            reusable = {child.node: child for child in self.children
+                        if isinstance(child, BlockLayout)}
+        self.children = []
         if mode == "block":
-            self.layout_intermediate()
+            self.layout_intermediate(reusable)
         else:
             self.new_line()
             self.recurse(self.node)
+        return True
 
-        for child in self.children:
-            child.layout()
-
+    def finish_layout(self):
         self.height = sum([child.height for child in self.children])
+        self.node.layout_dirty = False
+        self.laid_out = (self.x, self.width)
+
+    def shift(self, dy):
+        for obj in walk_tree(self):
+            obj.y += dy
 
     def recurse(self, node):
-        if isinstance(node, Text):
-            for word in node.text.split():
-                self.word(node, word)
-        else:
-            if node.tag == "br":
+        for node in walk_tree(node):
+            node.layout_dirty = False
+            if isinstance(node, Text):
+                for word in node.text.split():
+                    self.word(node, word)
+            elif node.tag == "br":
                 self.new_line()
-            for child in node.children:
-                self.recurse(child)
 
     def word(self, node, word):
-        weight = node.style['font-weight']
-        style = node.style['font-style']
-        if style == 'normal': style = "roman"
-        size = int(float(node.style['font-size'][:-2]) * .75)
-        font = get_font(size, weight, style)
-        w = font.measure(word)
+        font = node_font(node)
+        w = measure_cache.measure(font, word)
         if self.cursor_x + w > self.width:
             self.new_line()
         line = self.children[-1]
         previous_word = line.children[-1] if line.children else None
         text = TextLayout(node, word, line, previous_word)
         line.children.append(text)
-        self.cursor_x += w + font.measure(' ')
+        self.cursor_x += w + measure_cache.measure(font, ' ')
 
     def new_line(self):
         self.cursor_x = 0
@@ -655,6 +1733,8 @@ class BlockLayout:
             self.x, self.y, self.width, self.height, repr(self.node))
 
 class LineLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y",
+                 "width", "height")
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -677,12 +1757,16 @@ class LineLayout:
         for word in self.children:
             word.layout()
 
-        max_ascent = max([word.font.metrics("ascent")
+        if not self.children:
+            self.height = 0
+            return
+
+        max_ascent = max([measure_cache.metrics(word.font, "ascent")
                   for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
-        max_descent = max([word.font.metrics("descent")
+            word.y = baseline - measure_cache.metrics(word.font, "ascent")
+        max_descent = max([measure_cache.metrics(word.font, "descent")
                     for word in self.children])
 
         self.height = 1.25 * (max_ascent + max_descent)
@@ -691,53 +1775,289 @@ class LineLayout:
         return []
 
 class TextLayout:
+    __slots__ = ("node", "word", "parent", "previous", "children", "font",
+                 "x", "y", "width", "height")
     def __init__(self, node, word, parent, previous):
         self.node = node
         self.word = word
         self.parent = parent
         self.previous = previous
-        self.children = []
+        self.children = NO_CHILDREN
 
     def __repr__(self):
         return ("TextLayout(x={}, y={}, width={}, height={}, word={})").format(
             self.x, self.y, self.width, self.height, self.word)
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        self.font = node_font(self.node)
 
-        self.width = self.font.measure(self.word)
+        self.width = measure_cache.measure(self.font, self.word)
 
         if self.previous:
-            space = self.font.measure(" ")
+            space = measure_cache.measure(self.font, " ")
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = measure_cache.metrics(self.font, "linespace")
 
     def paint(self):
         color = self.node.style["color"]
         return [DrawText(self.x, self.y, self.word, self.font, color)]
 
 def paint_tree(layout_object, display_list):
-    display_list.extend(layout_object.paint())
-
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+    for obj in walk_tree(layout_object):
+        display_list.extend(obj.paint())
 
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(walk_tree(tree))
     return list
 
+def invisible(cmd):
+    if getattr(cmd, "color", None) == "transparent": return True
+    if isinstance(cmd, DrawText): return not cmd.text
+    if isinstance(cmd, DrawRect):
+        return cmd.rect.left >= cmd.rect.right or \
+            cmd.rect.top >= cmd.rect.bottom
+    if isinstance(cmd, DrawOutline): return cmd.thickness <= 0
+    return False
+
+def continues_run(run, cmd):
+    # Layout puts words on a line one measured space apart, so a run of
+    # them can be drawn as one string starting at the first word.
+    return isinstance(cmd, DrawText) \
+        and run.font is cmd.font and run.color == cmd.color \
+        and run.rect.top == cmd.rect.top \
+        and run.rect.bottom == cmd.rect.bottom \
+        and cmd.rect.left == \
+            run.rect.right + measure_cache.measure(cmd.font, " ")
+
+def run_text(words):
+    return " ".join(word.text for word in words)
+
+def split_run(words):
+    # Word widths are rounded one at a time, so drawing a long run as one
+    # string drifts from the laid-out positions. Split the run into
+    # pieces sized from the measured drift, or return None if it stays
+    # within a pixel of layout.
+    first, last = words[0], words[-1]
+    drift = abs(measure_cache.measure(first.font, run_text(words)) -
+                (last.rect.right - first.rect.left))
+    if drift <= 1: return None
+    size = min(int((len(words) - 1) / drift) + 1, len(words) // 2)
+    return [words[i:i + size] for i in range(0, len(words), size)]
+
+def merge_run(words):
+    if len(words) == 1: return words[0]
+    first, last = words[0], words[-1]
+    run = copy.copy(first)
+    run.text = run_text(words)
+    run.rect = Rect(first.rect.left, first.rect.top,
+                    last.rect.right, first.rect.bottom)
+    return run
+
+def split_runs(runs):
+    # Splits happen in rounds, and each round's runs are measured in one
+    # batch so a worker thread waits on the Tk thread once per round.
+    pieces = {}
+    pending = [words for words in runs if len(words) > 1]
+    while pending:
+        if font_backend.queued():
+            measure_cache.measure_all(
+                [(words[0].font, run_text(words)) for words in pending])
+        next_round = []
+        for words in pending:
+            split = split_run(words)
+            if split is None: continue
+            pieces[id(words)] = split
+            next_round.extend(piece for piece in split if len(piece) > 1)
+        pending = next_round
+    return pieces
+
+def batch_display_list(display_list):
+    # Runs are collected first so their widths can be measured together.
+    batched = []
+    runs = []
+    words = None
+    for cmd in display_list:
+        if invisible(cmd): continue
+        if words and continues_run(words[-1], cmd):
+            words.append(cmd)
+            continue
+        if isinstance(cmd, DrawText):
+            words = [cmd]
+            runs.append(words)
+            batched.append(words)
+        else:
+            words = None
+            batched.append(cmd)
+    pieces = split_runs(runs)
+    merged = []
+    for item in batched:
+        if not isinstance(item, list):
+            merged.append(item)
+            continue
+        stack = [item]
+        while stack:
+            words = stack.pop()
+            if id(words) in pieces:
+                stack.extend(reversed(pieces[id(words)]))
+            else:
+                merged.append(merge_run(words))
+    return merged
+
 SCROLL_STEP = 100
 
+class DisplayListIndex:
+    # Commands taller than this are kept out of the sorted index so that a
+    # page-sized background does not widen every query.
+    TALL = 1000
+
+    def __init__(self, display_list):
+        self.display_list = display_list
+        self.tall = []
+        self.max_height = 0
+        entries = []
+        for i, cmd in enumerate(display_list):
+            height = max(cmd.rect.bottom - cmd.rect.top, 0)
+            if height > self.TALL:
+                self.tall.append(i)
+            else:
+                entries.append((cmd.rect.top, i))
+                self.max_height = max(self.max_height, height)
+        entries.sort()
+        self.tops = [top for top, i in entries]
+        self.indices = [i for top, i in entries]
+
+    def query_indices(self, top, bottom):
+        lo = bisect.bisect_left(self.tops, top - self.max_height)
+        hi = bisect.bisect_right(self.tops, bottom)
+        found = [i for i in itertools.chain(self.indices[lo:hi], self.tall)
+                 if self.display_list[i].rect.top <= bottom
+                 and self.display_list[i].rect.bottom >= top]
+        found.sort()
+        return found
+
+    def query(self, top, bottom):
+        return [self.display_list[i]
+                for i in self.query_indices(top, bottom)]
+
+class HitTestIndex:
+    # Siblings whose subtree is taller than this are checked directly
+    # rather than through the sorted window, as in DisplayListIndex.
+    TALL = 1000
+
+    def __init__(self, document):
+        self.document = document
+        self.bounds = {}
+        self.children = {}
+        order = []
+        stack = [document]
+        while stack:
+            obj = stack.pop()
+            order.append(obj)
+            stack.extend(child for child in obj.children if child.children)
+        # Children come after their parent in order, so walking it
+        # backwards sees every subtree before the box that contains it.
+        bounds = self.bounds
+        for obj in reversed(order):
+            left, top = obj.x, obj.y
+            right, bottom = left + obj.width, top + obj.height
+            for child in obj.children:
+                if child.children:
+                    c_left, c_top, c_right, c_bottom = bounds[id(child)]
+                else:
+                    c_left, c_top = child.x, child.y
+                    c_right = c_left + child.width
+                    c_bottom = c_top + child.height
+                if c_left < left: left = c_left
+                if c_top < top: top = c_top
+                if c_right > right: right = c_right
+                if c_bottom > bottom: bottom = c_bottom
+            bounds[id(obj)] = (left, top, right, bottom)
+        self.links = {}
+
+    def box(self, obj):
+        if obj.children: return self.bounds[id(obj)]
+        return (obj.x, obj.y, obj.x + obj.width, obj.y + obj.height)
+
+    def child_index(self, obj):
+        # Built the first time a query reaches obj, so a click only pays
+        # for the boxes along its own path.
+        tall = []
+        entries = []
+        max_height = 0
+        for i, child in enumerate(obj.children):
+            top, bottom = self.box(child)[1::2]
+            if bottom - top > self.TALL:
+                tall.append((i, child))
+            else:
+                entries.append((top, i, child))
+                max_height = max(max_height, bottom - top)
+        entries.sort()
+        index = ([entry[0] for entry in entries],
+                 [(i, child) for _, i, child in entries],
+                 max_height, tall)
+        self.children[id(obj)] = index
+        return index
+
+    def candidates(self, obj, x, y):
+        if not obj.children: return []
+        index = self.children.get(id(obj))
+        if index is None:
+            index = self.child_index(obj)
+        tops, entries, max_height, tall = index
+        lo = bisect.bisect_left(tops, y - max_height)
+        hi = bisect.bisect_right(tops, y)
+        found = []
+        for i, child in itertools.chain(entries[lo:hi], tall):
+            left, top, right, bottom = self.box(child)
+            if left <= x < right and top <= y < bottom:
+                found.append((i, child))
+        found.sort(key=lambda entry: entry[0])
+        return [child for _, child in found]
+
+    def hit(self, x, y):
+        # The last layout object in tree order that contains the point:
+        # visit later siblings first and a parent after its children.
+        stack = [(self.document, False)]
+        while stack:
+            obj, children_done = stack.pop()
+            if children_done:
+                if obj.x <= x < obj.x + obj.width \
+                        and obj.y <= y < obj.y + obj.height:
+                    return obj
+                continue
+            stack.append((obj, True))
+            stack.extend((child, False)
+                         for child in self.candidates(obj, x, y))
+        return None
+
+    def link(self, node):
+        # Nearest <a href> at or above node, remembered for every node
+        # on the way up so later lookups stop at the first known one.
+        path = []
+        link = None
+        while node is not None:
+            if id(node) in self.links:
+                link = self.links[id(node)]
+                break
+            path.append(node)
+            node = node.parent
+        for node in reversed(path):
+            if isinstance(node, Element) and node.tag == "a" \
+                    and "href" in node.attributes:
+                link = node
+            self.links[id(node)] = link
+        return link
+
+    def link_at(self, x, y):
+        obj = self.hit(x, y)
+        if obj is None: return None
+        return self.link(obj.node)
+
 class DrawText:
+    __slots__ = ("text", "font", "rect", "color")
 
     def __repr__(self):
         return "DrawText(top={} left={} bottom={} text={} font={} color={})" \
@@ -748,12 +2068,13 @@ class DrawText:
         self.font = font
         self.rect = Rect(
             x1, y1,
-            x1 + self.font.measure(self.text), y1 + font.metrics('linespace')
+            x1 + measure_cache.measure(self.font, self.text),
+            y1 + measure_cache.metrics(font, 'linespace')
         )
         self.color = color
 
     def execute(self, scroll, canvas):
-        canvas.create_text(
+        return canvas.create_text(
             self.rect.left,
             self.rect.top - scroll,
             text=self.text,
@@ -763,6 +2084,7 @@ class DrawText:
         )
 
 class DrawRect:
+    __slots__ = ("rect", "color")
 
     def __repr__(self):
         return "DrawRect(top={} left={} bottom={} right={} color={})".format(
@@ -773,7 +2095,7 @@ class DrawRect:
         self.color = color
 
     def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+        return canvas.create_rectangle(
             self.rect.left,
             self.rect.top - scroll,
             self.rect.right,
@@ -783,13 +2105,14 @@ class DrawRect:
         )
 
 class DrawOutline:
+    __slots__ = ("rect", "color", "thickness")
     def __init__(self, rect, color, thickness):
         self.rect = rect
         self.color = color
         self.thickness = thickness
 
     def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+        return canvas.create_rectangle(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
             width=self.thickness,
@@ -797,13 +2120,14 @@ class DrawOutline:
         )
 
 class DrawLine:
+    __slots__ = ("rect", "color", "thickness")
     def __init__(self, x1, y1, x2, y2, color, thickness):
         self.rect = Rect(x1, y1, x2, y2)
         self.color = color
         self.thickness = thickness
 
     def execute(self, scroll, canvas):
-        canvas.create_line(
+        return canvas.create_line(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
             fill=self.color, width=self.thickness)
@@ -816,14 +2140,156 @@ def set_parameters(**params):
     if "VSTEP" in params: VSTEP = params["VSTEP"]
     if "SCROLL_STEP" in params: SCROLL_STEP = params["SCROLL_STEP"]
 
-DEFAULT_STYLE_SHEET = CSSParser(open('browser.css').read()).parse()
+DEFAULT_STYLE_SHEET_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "browser.css")
+COMPILED_STYLE_SHEET_PATH = os.path.join(CACHE_DIR, "browser.css.json")
+# Bump when the stored layout of rules changes.
+COMPILED_STYLE_SHEET_FORMAT = 1
+
+default_style_sheet_rules = None
+
+def compile_rules(rules):
+    # Only plain data is stored, so the cache never refers to a particular
+    # copy of the selector classes (browser vs __main__, or an older one).
+    return [[selector.tags, body] for selector, body in rules]
+
+def decompile_rules(compiled):
+    rules = []
+    for tags, body in compiled:
+        selector = TagSelector(tags[0])
+        for tag in tags[1:]:
+            selector = DescendantSelector(selector, TagSelector(tag))
+        rules.append((selector, body))
+    return rules
+
+def load_default_style_sheet():
+    stat = os.stat(DEFAULT_STYLE_SHEET_PATH)
+    compiled = None
+    try:
+        with open(COMPILED_STYLE_SHEET_PATH, "r") as f:
+            compiled = json.load(f)
+        if compiled["format"] != COMPILED_STYLE_SHEET_FORMAT:
+            compiled = None
+        elif compiled["mtime"] == stat.st_mtime_ns and \
+                compiled["size"] == stat.st_size:
+            return decompile_rules(compiled["rules"])
+    except Exception:
+        compiled = None
+    with open(DEFAULT_STYLE_SHEET_PATH, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if compiled is not None and compiled.get("digest") == digest:
+        rules = decompile_rules(compiled["rules"])
+    else:
+        rules = CSSParser(data.decode("utf8")).parse()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(COMPILED_STYLE_SHEET_PATH + ".tmp", "w") as f:
+            json.dump({
+                "format": COMPILED_STYLE_SHEET_FORMAT,
+                "mtime": stat.st_mtime_ns, "size": stat.st_size,
+                "digest": digest, "rules": compile_rules(rules),
+            }, f)
+        os.replace(COMPILED_STYLE_SHEET_PATH + ".tmp",
+                   COMPILED_STYLE_SHEET_PATH)
+    except OSError:
+        pass
+    return rules
+
+def default_style_sheet():
+    global default_style_sheet_rules
+    if default_style_sheet_rules is None:
+        default_style_sheet_rules = load_default_style_sheet()
+    return default_style_sheet_rules
+
+def __getattr__(name):
+    if name == "DEFAULT_STYLE_SHEET":
+        return default_style_sheet()
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
+
+class StyleSheetCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def parse(self, url, body):
+        key = (repr(url), hashlib.sha256(body.encode("utf8")).hexdigest())
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        rules = CSSParser(body).parse()
+        with self.lock:
+            self.cache[key] = rules
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return rules
+
+style_sheet_cache = StyleSheetCache()
+
+PROGRESSIVE_RENDER_INTERVAL = 0.1
+
+BACK_FORWARD_CACHE_BYTES = 64 * 1024 * 1024
+
+class BackForwardCache:
+    # Pages the tab navigated away from, keyed by their history entry.
+    # The same URL can appear in history several times, so entries are
+    # keyed by the URL object rather than its text.
+    def __init__(self, max_bytes=BACK_FORWARD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def put(self, url, page, size):
+        self.remove(url)
+        if size <= self.max_bytes:
+            self.entries[id(url)] = (url, page, size)
+            self.size += size
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def take(self, url):
+        entry = self.entries.pop(id(url), None)
+        if entry is None: return None
+        self.size -= entry[2]
+        if entry[0] is not url: return None
+        return entry[1]
+
+    def remove(self, url):
+        entry = self.entries.pop(id(url), None)
+        if entry is not None:
+            self.size -= entry[2]
 
 class Tab:
     def __init__(self, tab_height):
         self.scroll = 0
         self.url = None
+        # The URL of the page on screen, which lags self.url while a
+        # navigation is loading.
+        self.page_url = None
         self.tab_height = tab_height
         self.history = []
+        self.on_progress = None
+        self.hit_index = None
+        self.nodes = None
+        self.document = None
+        # The per-word display list is only needed to print or inspect a
+        # page; normally just its batched draw list is kept.
+        self.keep_display_list = False
+        self.display_list = []
+        self.command_count = 0
+        self.draw_list = []
+        self.display_index = DisplayListIndex([])
+        self.commit_queue = None
+        self.navigation = None
+        self.committed = None
+        self.forward = []
+        self.bfcache = BackForwardCache()
+        self.scroll_after_load = 0
+        self.discarded = False
 
     def __repr__(self):
         return "Tab(history={})".format(self.history)
@@ -832,37 +2298,205 @@ class Tab:
         self.scroll = max(self.scroll - SCROLL_STEP, 0)
 
     def scrolldown(self):
+        if self.document is None: return
         max_y = max(self.document.height + 2 * VSTEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
 
     def click(self, x, y):
+        if self.document is None: return
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs: return
-        elt = objs[-1].node
-        while elt:
-            if isinstance(elt, Text):
-                pass
-            elif elt.tag == "a" and "href" in elt.attributes:
-                url = self.url.resolve(elt.attributes["href"])
-                return self.load(url)
-            elt = elt.parent
+        if self.hit_index is None:
+            self.hit_index = HitTestIndex(self.document)
+        elt = self.hit_index.link_at(x, y)
+        if elt is not None:
+            url = self.page_url.resolve(elt.attributes["href"])
+            return self.navigate(url)
 
     def go_back(self):
         if len(self.history) > 1:
-            self.history.pop()
-            back = self.history.pop()
-            self.load(back)
+            self.save_page()
+            self.forward.append(self.history.pop())
+            self.restore(self.history.pop())
+
+    def go_forward(self):
+        if self.forward:
+            self.save_page()
+            self.restore(self.forward.pop())
+
+    def navigate(self, url):
+        self.save_page()
+        for entry in self.forward:
+            self.bfcache.remove(entry)
+        self.forward = []
+        self.fetch(url)
+
+    def fetch(self, url):
+        if self.commit_queue is None:
+            return self.load(url)
+        self.load_in_background(url)
+
+    def save_page(self):
+        # Only a finished page is worth keeping; while a navigation is in
+        # flight the tab may be showing a partial render.
+        if self.document is None or self.navigation is not None: return
+        page = {name: getattr(self, name)
+                for name in self.PAGE_FIELDS + ("hit_index", "scroll")}
+        self.bfcache.put(self.history[-1], page, estimate_page_bytes(self))
+
+    def discard(self, keep_dom=True):
+        # Drop everything that can be rebuilt: the layout tree, display
+        # lists and cached history pages, and with keep_dom=False the DOM
+        # too. The URL, history and scroll offset stay.
+        self.document = None
+        self.display_list = []
+        self.command_count = 0
+        self.draw_list = []
+        self.display_index = DisplayListIndex([])
+        self.hit_index = None
+        self.bfcache = BackForwardCache(self.bfcache.max_bytes)
+        if not keep_dom:
+            self.nodes = None
+        self.discarded = True
+
+    def rebuild(self):
+        self.discarded = False
+        if self.nodes is None:
+            if not self.history: return
+            scroll = self.scroll
+            url = self.history.pop()
+            if self.commit_queue is None:
+                self.load(url)
+                self.scroll = scroll
+            else:
+                self.load_in_background(url, scroll)
+            return
+        if self.commit_queue is None:
+            return self.layout()
+        # Lay the kept DOM out again on a worker thread. Nothing is added
+        # to history, so the navigation counts as committed already.
+        navigation = self.start_navigation(self.scroll)
+        self.committed = navigation
+        loader = Tab(self.tab_height)
+        loader.page_url = self.page_url
+        loader.nodes = self.nodes
+        loader.rules = self.rules
+        self.build_in_background(navigation, loader, loader.layout)
+
+    def layout(self):
+        if font_backend.queued():
+            prefetch_widths(self.nodes)
+        self.document = DocumentLayout(self.nodes)
+        with tracer.span("layout"):
+            self.document.layout()
+        self.paint()
+
+    def restore(self, url):
+        page = self.bfcache.take(url)
+        if page is None:
+            return self.fetch(url)
+        if self.navigation is not None:
+            self.navigation.set()
+            self.navigation = None
+        self.history.append(url)
+        self.url = url
+        for name, value in page.items():
+            setattr(self, name, value)
 
-    def load(self, url: URL):
+    def load(self, url: URL, cancelled=None):
         self.history.append(url)
         self.scroll = 0
         self.url = url
-        body = url.request()
-        self.nodes = HTMLParser(body).parse()
-        rules = DEFAULT_STYLE_SHEET.copy()
+        parser = HTMLParser()
+        stylesheets = {}
+        interval = PROGRESSIVE_RENDER_INTERVAL
+        last_render = time.time()
+        for chunk in url.stream():
+            if cancelled is not None and cancelled.is_set():
+                raise LoadCancelled(url)
+            with tracer.span("parse"):
+                parser.feed(chunk)
+            if self.on_progress is None or parser.root() is None: continue
+            if time.time() - last_render < interval: continue
+            # The response still holds a pooled connection here, so only
+            # use style sheets that have already arrived.
+            self.render(parser.root(), stylesheets, wait=False)
+            self.on_progress(self)
+            # Back off so repeated partial renders stay a small fraction
+            # of the total load time on long downloads.
+            interval *= 2
+            last_render = time.time()
+        with tracer.span("parse"):
+            nodes = parser.close()
+        if cancelled is not None and cancelled.is_set():
+            raise LoadCancelled(url)
+        self.render(nodes, stylesheets)
+
+    PAGE_FIELDS = ("page_url", "nodes", "rules", "document", "command_count",
+                   "draw_list", "display_index")
+
+    def start_navigation(self, scroll):
+        # Setting the event abandons the previous navigation's work.
+        if self.navigation is not None:
+            self.navigation.set()
+        navigation = threading.Event()
+        self.navigation = navigation
+        self.scroll_after_load = scroll
+        return navigation
+
+    def load_in_background(self, url, scroll=0):
+        navigation = self.start_navigation(scroll)
+        self.history.append(url)
+        self.url = url
+        loader = Tab(self.tab_height)
+        self.build_in_background(
+            navigation, loader, lambda: loader.load(url, navigation))
+
+    def build_in_background(self, navigation, loader, build):
+        # The page is built on a worker thread in a scratch Tab, and each
+        # render is handed to the UI thread through commit_queue.
+        def post(final):
+            page = {name: getattr(loader, name) for name in self.PAGE_FIELDS}
+            self.commit_queue.put((self, navigation, page, final))
+
+        def run():
+            try:
+                build()
+            except LoadCancelled:
+                return
+            except Exception:
+                traceback.print_exc()
+                # No page: the UI thread ends the navigation instead.
+                self.commit_queue.put((self, navigation, None, True))
+                return
+            post(True)
+
+        loader.on_progress = lambda loader: post(False)
+        threading.Thread(target=run, daemon=True).start()
+
+    def commit(self, navigation, page, final):
+        if navigation is not self.navigation: return
+        if page is None:
+            # The load failed. Keep whatever is on screen; if nothing from
+            # it was ever shown, that is still the previous page, so put
+            # history and the address back to match.
+            self.navigation = None
+            if self.committed is not navigation:
+                self.history.pop()
+                self.url = self.history[-1] if self.history else None
+            return
+        if self.committed is not navigation:
+            self.committed = navigation
+            self.scroll = self.scroll_after_load
+        for name, value in page.items():
+            setattr(self, name, value)
+        self.hit_index = None
+        if final:
+            self.navigation = None
+
+    def render(self, nodes, stylesheets, wait=True):
+        self.page_url = self.url
+        self.nodes = nodes
+        rules = default_style_sheet().copy()
         links = [node.attributes["href"]
              for node in tree_to_list(self.nodes, [])
              if isinstance(node, Element)
@@ -870,25 +2504,136 @@ class Tab:
              and node.attributes.get("rel") == "stylesheet"
              and "href" in node.attributes]
         for link in links:
-            style_url = url.resolve(link)
-            try:
-                body = style_url.request()
-            except:
-                continue
-            rules.extend(CSSParser(body).parse())
-        style(self.nodes, sorted(rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+            if link not in stylesheets:
+                style_url = self.url.resolve(link)
+                stylesheets[link] = \
+                    (style_url, subresource_loader.submit(style_url))
+        for link in links:
+            style_url, future = stylesheets[link]
+            if not wait and not future.done(): continue
+            with tracer.span("wait for style sheet", args={"href": link}):
+                try:
+                    body = future.result()
+                except Exception:
+                    continue
+            with tracer.span("parse css", args={"href": link}):
+                rules.extend(style_sheet_cache.parse(style_url, body))
+        self.rules = RuleIndex(sorted(rules, key=cascade_priority))
+        with tracer.span("style"):
+            style(self.nodes, self.rules)
+        self.layout()
+
+    def paint(self):
+        with tracer.span("paint"):
+            display_list = []
+            paint_tree(self.document, display_list)
+            self.draw_list = batch_display_list(display_list)
+            self.display_index = DisplayListIndex(self.draw_list)
+            self.hit_index = None
+        self.display_list = display_list if self.keep_display_list else []
+        self.command_count = len(display_list)
+        if tracer.enabled:
+            tracer.set_counter("nodes", len(tree_to_list(self.nodes, [])))
+            tracer.set_counter("display list", self.command_count)
+            tracer.set_counter("draw list", len(self.draw_list))
+            tracer.emit_counters()
+
+    def add_style_sheet(self, body):
+        new_rules = CSSParser(body).parse()
+        self.rules = RuleIndex(sorted(self.rules.rules + new_rules,
+                                      key=cascade_priority))
+        # Only elements keyed by one of the new rules can change style.
+        mark_tags_dirty(self.nodes,
+                        {self.rules.key(selector) for selector, _ in new_rules})
+        self.restyle()
+
+    def restyle(self):
+        with tracer.span("style"):
+            restyle(self.nodes, self.rules)
+        with tracer.span("layout"):
+            self.document.layout()
+        self.paint()
 
     def draw(self, canvas, offset):
-        for cmd in self.display_list:
-            if cmd.rect.top > self.scroll + self.tab_height: continue
-            if cmd.rect.bottom < self.scroll: continue
+        visible = self.display_index.query(
+            self.scroll, self.scroll + self.tab_height)
+        for cmd in visible:
             cmd.execute(self.scroll - offset, canvas)
 
+def load_headless(url, tab_height=HEIGHT):
+    if not isinstance(font_backend, HeadlessFontBackend):
+        set_font_backend(HeadlessFontBackend())
+    tab = Tab(tab_height)
+    tab.keep_display_list = True
+    tab.load(url)
+    return tab
+
+def memory_report(tab):
+    # Bytes held by each phase's own objects. Anything shared (interned
+    # strings, style dictionaries, fonts) is counted once, in the first
+    # phase that reaches it.
+    seen = set()
+    def size(*objs):
+        total = 0
+        for obj in objs:
+            if id(obj) in seen: continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+        return total
+
+    report = {}
+    nodes = tree_to_list(tab.nodes, [])
+    total = 0
+    for node in nodes:
+        total += size(node, node.children)
+        if isinstance(node, Text):
+            total += size(node.text)
+        else:
+            total += size(node.tag, node.attributes,
+                          *node.attributes.keys(), *node.attributes.values())
+    report["dom"] = total
+
+    total = 0
+    for node in nodes:
+        if id(node.style) in seen: continue
+        computed = gc.get_referents(node.style)[0]
+        total += size(node.style, computed, *computed.values())
+    report["style"] = total
+
+    total = 0
+    for obj in tree_to_list(tab.document, []):
+        total += size(obj, obj.children)
+        if isinstance(obj, TextLayout):
+            total += size(obj.word)
+    report["layout"] = total
+
+    phases = [("draw list", tab.draw_list)]
+    if tab.keep_display_list:
+        phases.insert(0, ("display list", tab.display_list))
+    for name, commands in phases:
+        total = size(commands)
+        for cmd in commands:
+            total += size(cmd, cmd.rect)
+            if isinstance(cmd, DrawText):
+                total += size(cmd.text)
+        report[name] = total
+    return report
+
+# Bytes per DOM node (with its share of computed styles), per painted
+# command (its share of the layout tree) and per draw list entry, as
+# measured by memory_report on generated pages.
+PAGE_BYTES_PER_NODE = 320
+PAGE_BYTES_PER_COMMAND = 260
+PAGE_BYTES_PER_DRAW = 130
+
+def estimate_page_bytes(tab):
+    # memory_report visits every object; this only needs a DOM walk.
+    return PAGE_BYTES_PER_NODE * len(tree_to_list(tab.nodes, [])) + \
+        PAGE_BYTES_PER_COMMAND * tab.command_count + \
+        PAGE_BYTES_PER_DRAW * len(tab.draw_list)
+
 class Rect:
+    __slots__ = ("left", "top", "right", "bottom")
     def __init__(self, left, top, right, bottom):
         self.left = left
         self.top = top
@@ -902,11 +2647,11 @@ class Chrome:
     def __init__(self, browser):
         self.browser = browser
         self.font = get_font(20, "normal", "roman")
-        self.font_height = self.font.metrics("linespace")
+        self.font_height = measure_cache.metrics(self.font, "linespace")
         self.padding = 5
         self.tabbar_top = 0
         self.tabbar_bottom = self.font_height + 2 * self.padding
-        plus_width = self.font.measure("+") + 2 * self.padding
+        plus_width = measure_cache.measure(self.font, "+") + 2 * self.padding
         self.newtab_rect = Rect(
             self.padding, self.padding,
             self.padding + plus_width,
@@ -916,7 +2661,7 @@ class Chrome:
         self.urlbar_bottom = self.urlbar_top + self.font_height + 2 * self.padding
         self.bottom = self.urlbar_bottom
 
-        back_width = self.font.measure("<") + 2 * self.padding
+        back_width = measure_cache.measure(self.font, "<") + 2 * self.padding
         self.back_rect = Rect(
             self.padding,
             self.urlbar_top + self.padding,
@@ -932,6 +2677,7 @@ class Chrome:
         )
         self.focus = None
         self.address_bar = ""
+        self.hud = False
 
     def click(self, x, y):
         if self.newtab_rect.containsPoint(x, y):
@@ -944,7 +2690,7 @@ class Chrome:
         else:
             for i, tab in enumerate(self.browser.tabs):
                 if self.tab_rect(i).containsPoint(x, y):
-                    self.browser.active_tab = tab
+                    self.browser.set_active_tab(tab)
                     break
 
     def keypress(self, char):
@@ -953,7 +2699,7 @@ class Chrome:
 
     def enter(self):
         if self.focus == "address bar":
-            self.browser.active_tab.load(URL(self.address_bar))
+            self.browser.active_tab.navigate(URL(self.address_bar))
             self.focus = None
 
     def backspace(self):
@@ -962,12 +2708,18 @@ class Chrome:
 
     def tab_rect(self, i):
         tabs_start = self.newtab_rect.right + self.padding
-        tab_width = self.font.measure("Tab X") + 2 * self.padding
+        tab_width = measure_cache.measure(self.font, "Tab X") + 2 * self.padding
         return Rect(
             tabs_start + tab_width * i, self.tabbar_top,
             tabs_start + tab_width * (i + 1), self.tabbar_bottom
         )
 
+    def state(self):
+        tabs = self.browser.tabs
+        return (len(tabs), tabs.index(self.browser.active_tab),
+                str(self.browser.active_tab.url), self.focus,
+                self.address_bar)
+
     def paint(self):
         cmds = []
 
@@ -1022,7 +2774,7 @@ class Chrome:
                 self.address_bar, self.font, "black"
             ))
 
-            w = self.font.measure(self.address_bar)
+            w = measure_cache.measure(self.font, self.address_bar)
             cmds.append(DrawLine(
                 self.address_rect.left + self.padding + w,
                 self.address_rect.top,
@@ -1038,10 +2790,146 @@ class Chrome:
 
         return cmds
 
+    def hud_text(self):
+        return "  ".join(
+            "{} {:.1f}ms".format(name, tracer.last[name] * 1000)
+            for name in ["parse", "style", "layout", "paint", "draw"]
+            if name in tracer.last)
+
+    def paint_hud(self, text):
+        font = get_font(10, "normal", "roman")
+        if not text: return []
+        height = measure_cache.metrics(font, "linespace")
+        top = HEIGHT - height - 2 * self.padding
+        return [
+            DrawRect(Rect(0, top, WIDTH, HEIGHT), "lightyellow"),
+            DrawText(self.padding, top + self.padding, text, font, "black"),
+        ]
+
+TAB_MEMORY_BUDGET = 256 * 1024 * 1024
+
+class TabManager:
+    # Keeps the estimated memory of all tabs under a budget by discarding
+    # the least recently used background tabs; they are rebuilt when
+    # switched back to.
+    def __init__(self, budget=TAB_MEMORY_BUDGET, keep_dom=True):
+        self.budget = budget
+        self.keep_dom = keep_dom
+        self.recent = collections.OrderedDict()
+        self.sizes = {}
+
+    def activate(self, tab):
+        self.recent[tab] = None
+        self.recent.move_to_end(tab)
+        if tab.discarded:
+            tab.rebuild()
+
+    def tab_bytes(self, tab):
+        # A tab's page only changes when it gets a new draw list, so the
+        # estimate is recomputed just then.
+        entry = self.sizes.get(tab)
+        if entry is None or entry[0] is not tab.draw_list:
+            size = estimate_page_bytes(tab) if tab.nodes is not None else 0
+            entry = self.sizes[tab] = (tab.draw_list, size)
+        return entry[1] + tab.bfcache.size
+
+    def total_bytes(self):
+        return sum(self.tab_bytes(tab) for tab in self.recent)
+
+    def enforce(self, active):
+        total = self.total_bytes()
+        for tab in list(self.recent):
+            if total <= self.budget: break
+            if tab is active or tab.discarded: continue
+            if tab.document is None: continue
+            if tab.navigation is not None: continue
+            before = self.tab_bytes(tab)
+            tab.discard(self.keep_dom)
+            total -= before - self.tab_bytes(tab)
+
+class RetainedCanvas:
+    # Page items are kept this far beyond the visible area so that a
+    # scroll step usually only moves existing items.
+    MARGIN = 2 * SCROLL_STEP
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.draw_list = None
+        self.offset = None
+        self.scroll = 0
+        self.items = {}
+        self.drawn = []
+        self.chrome_state = None
+        self.hud_text = None
+
+    def clear_page(self):
+        self.canvas.delete("page")
+        self.items = {}
+        self.drawn = []
+
+    def draw_page(self, tab, offset):
+        if tab.draw_list is not self.draw_list or offset != self.offset:
+            self.clear_page()
+            self.draw_list = tab.draw_list
+            self.offset = offset
+        elif tab.scroll != self.scroll:
+            self.canvas.move("page", 0, self.scroll - tab.scroll)
+        self.scroll = tab.scroll
+
+        top = tab.scroll - self.MARGIN
+        bottom = tab.scroll + tab.tab_height + self.MARGIN
+        wanted = tab.display_index.query_indices(top, bottom)
+        keep = set(wanted)
+        for i in [i for i in self.drawn if i not in keep]:
+            self.canvas.delete(self.items.pop(i))
+        self.drawn = [i for i in self.drawn if i in keep]
+
+        created = False
+        for i in wanted:
+            if i in self.items: continue
+            item = self.draw_list[i].execute(tab.scroll - offset, self.canvas)
+            self.canvas.addtag_withtag("page", item)
+            # Keep paint order: slot the new item under the next command
+            # that is already on the canvas.
+            position = bisect.bisect_left(self.drawn, i)
+            if position < len(self.drawn):
+                self.canvas.tag_lower(item, self.items[self.drawn[position]])
+            self.drawn.insert(position, i)
+            self.items[i] = item
+            created = True
+        if created:
+            self.canvas.tag_raise("chrome")
+
+    def draw_chrome(self, chrome):
+        state = chrome.state()
+        if state == self.chrome_state: return
+        self.chrome_state = state
+        self.canvas.delete("chrome")
+        self.hud_text = None
+        for cmd in chrome.paint():
+            item = cmd.execute(0, self.canvas)
+            self.canvas.addtag_withtag("chrome", item)
+
+    def draw_hud(self, chrome):
+        # The timings change every frame, so the HUD is redrawn on its own
+        # rather than as part of the chrome.
+        text = chrome.hud_text() if chrome.hud else ""
+        if text == self.hud_text: return
+        self.hud_text = text
+        self.canvas.delete("hud")
+        for cmd in chrome.paint_hud(text):
+            item = cmd.execute(0, self.canvas)
+            self.canvas.addtag_withtag("chrome", item)
+            self.canvas.addtag_withtag("hud", item)
+
 class Browser:
+    COMMIT_INTERVAL = 16
+
     def __init__(self):
         self.tabs = []
         self.active_tab = None
+        self.tab_manager = TabManager()
+        import tkinter
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(
             self.window,
@@ -1050,6 +2938,7 @@ class Browser:
             bg="white"
         )
         self.canvas.pack()
+        self.retained = RetainedCanvas(self.canvas)
         self.chrome = Chrome(self)
         self.window.bind("<Up>", self.scrollup)
         self.window.bind("<Down>", self.scrolldown)
@@ -1057,6 +2946,11 @@ class Browser:
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
         self.window.bind("<BackSpace>", self.handle_backspace)
+        self.window.bind("<Alt-Left>", self.go_back)
+        self.window.bind("<Alt-Right>", self.go_forward)
+        self.commit_queue = queue.Queue()
+        font_backend.attach()
+        self.window.after(self.COMMIT_INTERVAL, self.commit_loads)
 
     def scrollup(self, e):
         self.active_tab.scrollup()
@@ -1066,6 +2960,14 @@ class Browser:
         self.active_tab.scrolldown()
         self.draw()
 
+    def go_back(self, e):
+        self.active_tab.go_back()
+        self.draw()
+
+    def go_forward(self, e):
+        self.active_tab.go_forward()
+        self.draw()
+
     def handle_click(self, e):
         if e.y < self.chrome.bottom:
             self.chrome.click(e.x, e.y)
@@ -1090,19 +2992,65 @@ class Browser:
         self.draw()
 
     def draw(self):
-        self.canvas.delete('all')
-        self.active_tab.draw(self.canvas, self.chrome.bottom)
-        for cmd in self.chrome.paint():
-            cmd.execute(0, self.canvas)
+        with tracer.span("draw"):
+            self.retained.draw_page(self.active_tab, self.chrome.bottom)
+            self.retained.draw_chrome(self.chrome)
+            self.retained.draw_hud(self.chrome)
+
+    def commit_loads(self):
+        # Loads finish on worker threads; their results are applied here,
+        # on the Tk thread, so event handlers never wait for the network.
+        font_backend.run_tasks()
+        redraw = False
+        while True:
+            try:
+                tab, navigation, page, final = self.commit_queue.get_nowait()
+            except queue.Empty:
+                break
+            tab.commit(navigation, page, final)
+            redraw = redraw or tab is self.active_tab
+            if final: self.tab_manager.enforce(self.active_tab)
+        if redraw: self.draw()
+        self.window.after(self.COMMIT_INTERVAL, self.commit_loads)
+
+    def set_active_tab(self, tab):
+        self.active_tab = tab
+        self.tab_manager.activate(tab)
+        self.tab_manager.enforce(tab)
 
     def new_tab(self, url):
         new_tab = Tab(HEIGHT - self.chrome.bottom)
-        new_tab.load(url)
-        self.active_tab = new_tab
+        new_tab.commit_queue = self.commit_queue
         self.tabs.append(new_tab)
+        self.set_active_tab(new_tab)
+        new_tab.navigate(url)
         self.draw()
 
 if __name__ == "__main__":
-    import sys
-    Browser().new_tab(URL(sys.argv[1]))
-    tkinter.mainloop()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--headless", action="store_true",
+                        help="print the display list instead of opening a window")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome trace (chrome://tracing) on exit")
+    parser.add_argument("--hud", action="store_true",
+                        help="show phase timings at the bottom of the window")
+    args = parser.parse_args()
+    cache = Cache(CACHE_DIR)
+    if args.trace or args.hud:
+        tracer.enabled = True
+    try:
+        if args.headless:
+            tab = load_headless(URL(args.url))
+            for cmd in tab.display_list:
+                print(cmd)
+        else:
+            import tkinter
+            browser = Browser()
+            browser.chrome.hud = args.hud
+            browser.new_tab(URL(args.url))
+            tkinter.mainloop()
+    finally:
+        if args.trace:
+            tracer.export(args.trace)
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+
+def serve(server, bodies):
+    # Answers one request per connection, then resets it, as a server
+    # dropping an idle keep-alive connection would.
+    for body in bodies:
+        conn, _ = server.accept()
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                     str(len(body)).encode() + b"\r\n\r\n" + body)
+        time.sleep(0.05)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack("ii", 1, 0))
+        conn.close()
+
+def test_reset_idle_connection_is_retried():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    port = server.getsockname()[1]
+    thread = threading.Thread(target=serve, args=(server, [b"one", b"two"]),
+                              daemon=True)
+    thread.start()
+    pool = browser.connection_pool
+    browser.connection_pool = browser.ConnectionPool()
+    try:
+        url = "http://127.0.0.1:{}/".format(port)
+        assert browser.URL(url + "a").request() == "one"
+        time.sleep(0.2)
+        assert browser.URL(url + "b").request() == "two"
+    finally:
+        browser.connection_pool.close_all()
+        browser.connection_pool = pool
+        server.close()
@@ -0,0 +1,62 @@
+"""Documents nested 10,000 deep must render under the default recursion
+limit: parse, style, restyle, layout, paint and click all walk the tree
+without recursing per level."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+
+DEPTH = 10000
+
+@pytest.fixture(autouse=True)
+def headless():
+    limit = sys.getrecursionlimit()
+    previous = browser.font_backend
+    browser.set_font_backend(browser.HeadlessFontBackend())
+    yield
+    browser.set_font_backend(previous)
+    assert sys.getrecursionlimit() == limit
+
+def nested(tags):
+    opening = "".join("<{}>".format(tags[i % len(tags)]) for i in range(DEPTH))
+    return opening + 'deep <a href="/target">link</a> text'
+
+@pytest.mark.parametrize("tags", [
+    ("div",),
+    ("b", "i"),
+    ("div", "span", "p"),
+], ids=["block", "inline", "mixed"])
+def test_deep_nesting(tags, monkeypatch):
+    nodes = browser.HTMLParser(nested(tags)).parse()
+    elements = [node for node in browser.tree_to_list(nodes, [])
+                if isinstance(node, browser.Element)]
+    assert len(elements) >= DEPTH
+
+    tab = browser.Tab(browser.HEIGHT)
+    tab.url = browser.URL("http://example.org/")
+    tab.keep_display_list = True
+    tab.render(nodes, {})
+    words = [cmd.text for cmd in tab.display_list
+             if isinstance(cmd, browser.DrawText)]
+    assert words == ["deep", "link", "text"]
+
+    # Restyle through an inline style and through a new style sheet.
+    anchor = next(node for node in elements if node.tag == "a")
+    anchor.parent.set_attribute("style", "color: red")
+    tab.restyle()
+    assert anchor.parent.style["color"] == "red"
+    tab.add_style_sheet("a { font-weight: bold }")
+    assert anchor.style["font-weight"] == "bold"
+    assert [cmd.text for cmd in tab.display_list
+            if isinstance(cmd, browser.DrawText)] == words
+
+    link = next(cmd for cmd in tab.display_list
+                if isinstance(cmd, browser.DrawText) and cmd.text == "link")
+    visited = []
+    monkeypatch.setattr(tab, "navigate", visited.append)
+    tab.click(link.rect.left + 1, link.rect.top + 1 - tab.scroll)
+    assert [str(url) for url in visited] == ["http://example.org/target"]
@@ -0,0 +1,39 @@
+import os
+import queue
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+
+def test_click_during_navigation_uses_page_url(monkeypatch):
+    previous = browser.font_backend
+    browser.set_font_backend(browser.HeadlessFontBackend())
+    # Accepts connections but never answers, so the navigation stays
+    # pending until the socket is closed.
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    port = server.getsockname()[1]
+    try:
+        tab = browser.Tab(browser.HEIGHT)
+        tab.url = browser.URL("http://example.org/a/page")
+        tab.keep_display_list = True
+        tab.history.append(tab.url)
+        tab.render(browser.HTMLParser('<a href="rel">link</a>').parse(), {})
+        tab.commit_queue = queue.Queue()
+        tab.load_in_background(
+            browser.URL("http://127.0.0.1:{}/other/slow/x".format(port)))
+        assert tab.navigation is not None
+
+        link = next(cmd for cmd in tab.display_list
+                    if isinstance(cmd, browser.DrawText))
+        visited = []
+        monkeypatch.setattr(tab, "navigate", visited.append)
+        tab.click(link.rect.left + 1, link.rect.top + 1)
+        assert [str(url) for url in visited] == ["http://example.org/a/rel"]
+    finally:
+        tab.navigation.set()
+        server.close()
+        browser.set_font_backend(previous)
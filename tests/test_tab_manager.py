@@ -0,0 +1,56 @@
+import os
+import queue
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import browser
+
+@pytest.fixture(autouse=True)
+def headless():
+    previous = browser.font_backend
+    browser.set_font_backend(browser.HeadlessFontBackend())
+    yield
+    browser.set_font_backend(previous)
+
+def rendered_tab(body):
+    tab = browser.Tab(browser.HEIGHT)
+    tab.url = browser.URL("http://example.org/")
+    tab.history.append(tab.url)
+    tab.render(browser.HTMLParser(body).parse(), {})
+    return tab
+
+def test_tab_without_page_is_not_discarded():
+    manager = browser.TabManager(budget=-1)
+    failed = browser.Tab(browser.HEIGHT)
+    active = rendered_tab("<p>hello</p>")
+    manager.activate(failed)
+    manager.activate(active)
+    manager.enforce(active)
+    assert not failed.discarded
+    manager.activate(failed)
+    assert failed.document is None
+
+def test_discarded_tab_with_empty_history_rebuilds():
+    tab = browser.Tab(browser.HEIGHT)
+    tab.discard(keep_dom=False)
+    tab.rebuild()
+    assert not tab.discarded and tab.document is None
+
+def test_kept_dom_is_laid_out_in_background():
+    tab = rendered_tab("<p>" + "word " * 500 + "</p>")
+    tab.scroll = 40
+    before = [repr(cmd) for cmd in tab.draw_list]
+    tab.discard(keep_dom=True)
+    tab.commit_queue = queue.Queue()
+    tab.rebuild()
+    assert tab.document is None and tab.navigation is not None
+    final = False
+    while not final:
+        _, navigation, page, final = tab.commit_queue.get(timeout=10)
+        tab.commit(navigation, page, final)
+    assert [repr(cmd) for cmd in tab.draw_list] == before
+    assert tab.scroll == 40 and tab.navigation is None
+    assert len(tab.history) == 1